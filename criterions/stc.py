@@ -5,6 +5,7 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
+import functools
 import gtn
 import torch
 import math
@@ -32,96 +33,108 @@ class STCLossFunction(torch.autograd.Function):
             STC label graph as gtn.Graph
         """
         g = gtn.Graph(False)
+        # bind the methods once, they are called O(L) times
+        add_node, add_arc = g.add_node, g.add_arc
+        log_prob = math.log(prob)
         L = len(target)
         S = 2 * L + 1
         # create self-less CTC graph
         for l in range(S):
             idx = (l - 1) // 2
-            g.add_node(l == 0, l == S - 1 or l == S - 2)
+            add_node(l == 0, l == S - 1 or l == S - 2)
             label = target[idx] if l % 2 else STC_BLANK_IDX
             if label == STC_BLANK_IDX:
-                g.add_arc(l, l, label)
+                add_arc(l, l, label)
             if l > 0:
-                g.add_arc(l - 1, l, label)
+                add_arc(l - 1, l, label)
             if l % 2 and l > 1:
-                g.add_arc(l - 2, l, label)
+                add_arc(l - 2, l, label)
 
         # add extra nodes/arcs required for STC
         for l in range(L + 1):
             p1 = 2 * l - 1
             p2 = 2 * l
 
-            c1 = g.add_node(False, l == L)
+            c1 = add_node(False, l == L)
             idx = star_idx if l == L else (star_idx + target[l])
             if p1 >= 0:
-                g.add_arc(p1, c1, idx, idx, math.log(prob))
-            g.add_arc(p2, c1, idx, idx, math.log(prob))
-            g.add_arc(c1, c1, idx, idx, math.log(prob))
+                add_arc(p1, c1, idx, idx, log_prob)
+            add_arc(p2, c1, idx, idx, log_prob)
+            add_arc(c1, c1, idx, idx, log_prob)
             if l < L:
-                g.add_arc(c1, 2 * l + 1, target[l])
-            g.add_arc(c1, p2, STC_BLANK_IDX)
+                add_arc(c1, 2 * l + 1, target[l])
+            add_arc(c1, p2, STC_BLANK_IDX)
 
         return g
 
     @staticmethod
     def forward(ctx, inputs, targets, prob, reduction="none"):
         B, T, Cstar = inputs.shape
-        losses, scales, emissions_graphs = [None] * B, [None] * B, [None] * B
+        losses, emissions_graphs = [None] * B, [None] * B
         C = Cstar // 2
 
+        # the scale is shared by every sample, apply it to the whole batch
+        scale = 1.0
+        if reduction == "mean":
+            scale = 1.0 / T if T > 0 else scale
+        elif reduction != "none":
+            raise ValueError("invalid value for reduction '" + str(reduction) + "'")
+
+        # one bulk device to host copy instead of one per sample
+        cpu_inputs = inputs.detach().cpu().contiguous()
+        # pinned so the upload below can be asynchronous
+        loss = torch.empty(B, pin_memory=inputs.is_cuda)
+        loss_data = loss.numpy()
+
+        # the cached label graphs embed the penalty, so drop them once it
+        # changes (every training step while it decays)
+        _clear_stale_stc_criteria(prob)
+
         def process(b):
             # create emission graph
             g_emissions = gtn.linear_graph(
                 T, Cstar, gtn.Device(gtn.CPU), inputs.requires_grad
             )
-            cpu_data = inputs[b].cpu().contiguous()
-            g_emissions.set_weights(cpu_data.data_ptr())
+            g_emissions.set_weights(cpu_inputs[b].data_ptr())
 
             # create criterion graph
-            g_criterion = STCLossFunction.create_stc_graph(targets[b], C, prob)
-            g_criterion.arc_sort(False)
+            g_criterion = _stc_criterion(tuple(targets[b]), C, prob)
 
             # compose the graphs
             g_loss = gtn.negate(
                 gtn.forward_score(gtn.compose(g_criterion, g_emissions))
             )
 
-            scale = 1.0
-            if reduction == "mean":
-                scale = 1.0 / T if T > 0 else scale
-            elif reduction != "none":
-                raise ValueError("invalid value for reduction '" + str(reduction) + "'")
+            loss_data[b] = g_loss.item()
 
             # Save for backward:
             losses[b] = g_loss
-            scales[b] = scale
             emissions_graphs[b] = g_emissions
 
         gtn.parallel_for(process, range(B))
 
-        ctx.auxiliary_data = (losses, scales, emissions_graphs, inputs.shape)
-        loss = torch.tensor([losses[b].item() * scales[b] for b in range(B)])
-        return torch.mean(loss.cuda() if inputs.is_cuda else loss)
+        ctx.auxiliary_data = (losses, scale, emissions_graphs, inputs.shape)
+        loss *= scale
+        return torch.mean(loss.to(inputs.device, non_blocking=True))
 
     @staticmethod
     def backward(ctx, grad_output):
-        losses, scales, emissions_graphs, in_shape = ctx.auxiliary_data
+        losses, scale, emissions_graphs, in_shape = ctx.auxiliary_data
         B, T, C = in_shape
-        input_grad = torch.empty((B, T, C))
+        # pinned so the upload below can be asynchronous
+        input_grad = torch.empty((B, T, C), pin_memory=grad_output.is_cuda)
+        # copy the gradients straight into the buffer through a numpy view
+        input_grad_data = input_grad.numpy().reshape(B, T * C)
 
         def process(b):
             gtn.backward(losses[b], False)
             emissions = emissions_graphs[b]
-            grad = emissions.grad().weights_to_numpy()
-            input_grad[b] = torch.from_numpy(grad).view(1, T, C) * scales[b]
+            input_grad_data[b] = emissions.grad().weights_to_numpy()
 
-        # Using a for loop instead of gtn.parallel_for
-        # gtn.parallel_for(process, range(B))
-        for b in range(B):
-            process(b)
+        gtn.parallel_for(process, range(B))
         if grad_output.is_cuda:
-            input_grad = input_grad.cuda()
-        input_grad *= grad_output / B
+            input_grad = input_grad.cuda(non_blocking=True)
+        input_grad *= grad_output * scale / B
 
         return (
             input_grad,
@@ -134,6 +147,46 @@ class STCLossFunction(torch.autograd.Function):
 STCLoss = STCLossFunction.apply
 
 
+@functools.lru_cache(maxsize=4096)
+def _stc_criterion(target, star_idx, prob):
+    """
+    Returns the arc sorted STC label graph for `target` (a tuple), reusing
+    the graph built for an identical target, star index and penalty. Stale
+    penalties are evicted by `_clear_stale_stc_criteria`.
+    """
+    g_criterion = STCLossFunction.create_stc_graph(target, star_idx, prob)
+    g_criterion.arc_sort(False)
+    return g_criterion
+
+
+_stc_criterion_prob = None
+
+
+def _clear_stale_stc_criteria(prob):
+    """
+    Empties the `_stc_criterion` cache if its graphs were built with a
+    different penalty than `prob`, so that only graphs which can still be
+    reused are kept.
+    """
+    global _stc_criterion_prob
+    if prob != _stc_criterion_prob:
+        _stc_criterion.cache_clear()
+        _stc_criterion_prob = prob
+
+
+@functools.lru_cache(maxsize=32)
+def _stc_token_map(tokens, num_tokens, device):
+    """
+    Returns the indices of the blank and `tokens` (a sorted tuple) on
+    `device`, and a CPU lookup tensor mapping each of them to its position,
+    reusing them while consecutive batches contain the same tokens.
+    """
+    select_idx = torch.tensor((STC_BLANK_IDX,) + tokens)
+    target_map = torch.full((num_tokens,), -1, dtype=torch.long)
+    target_map[select_idx] = torch.arange(len(select_idx))
+    return select_idx.to(device), target_map
+
+
 class STC(torch.nn.Module):
     """The Star Temporal Classification loss.
 
@@ -162,24 +215,27 @@ class STC(torch.nn.Module):
         Computes log(exp(a) - exp(b))
 
         Args:
-            a: Tensor of size (M x N)
+            a: Tensor of size (M x N x 1)
             b: Tensor of size (M x N x O)
         Returns:
             Tensor of size (M x N x O)
         """
 
         with torch.set_grad_enabled(a.requires_grad):
-            B, T, C = b.shape
-            a = a.tile((1, 1, C))
-            return a + torch.log1p(1e-7 - torch.exp(b - a))
+            # `a` is broadcast over the last dimension instead of tiled
+            if a.requires_grad:
+                return a + torch.log1p(1e-7 - torch.exp(b - a))
+            # no graph to record, so reuse a single buffer for every op
+            out = torch.exp(b - a)
+            return out.neg_().add_(1e-7).log1p_().add_(a)
 
     def forward(self, inputs, targets):
         """
         Computes STC loss for the given input and partialy labeled target
 
         Args:
-            inputs: Tensor of size (T, B, C)
-                T - # time steps, B - batch size, C - alphabet size (including blank)
+            inputs: Tensor of size (B, T, C)
+                B - batch size, T - # time steps, C - alphabet size (including blank)
                 The logarithmized probabilities of the outputs (e.g. obtained with torch.nn.functional.log_softmax())
             targets: list of size [B]
                 List of target sequences for each batch
@@ -195,39 +251,30 @@ class STC(torch.nn.Module):
         prob = self.plast + (self.p0 - self.plast) * math.exp(
             -self.nstep * math.log(2) / self.thalf
         )
-        # (T, B, C) --> (B, T, C)
-        log_probs = inputs.permute(1, 0, 2)
+        C = inputs.shape[2]
+        # select only the tokens present in current batch from the targets
+        # alone, so that the inputs are only swept once below
+        lengths = [len(target) for target in targets]
+        flat_targets = torch.cat(
+            [torch.as_tensor(target, dtype=torch.long) for target in targets]
+        )
+        tokens = torch.unique(flat_targets)
+        select_idx, target_map = _stc_token_map(
+            tuple(tokens[tokens != STC_BLANK_IDX].tolist()), C, inputs.device
+        )
 
-        B, T, C = log_probs.shape
-        # Store original vocabulary size for viterbi decoding
-        self._last_original_vocab_size = C
-        with torch.set_grad_enabled(log_probs.requires_grad):
-            # <star>
-            lse = torch.logsumexp(log_probs[:, :, 1:], 2, keepdim=True)
-
-            # select only the tokens present in current batch
-            select_idx = [STC_BLANK_IDX] + list(
-                set([t.item() for target in targets for t in target])
-            )
-            target_map = {}
-            for i, t in enumerate(select_idx):
-                target_map[t] = i
-
-            select_idx = torch.IntTensor(select_idx).to(log_probs.device)
-            log_probs = log_probs.index_select(2, select_idx)
-            targets = [[target_map[t.item()] for t in target] for target in targets]
-
-            # <star>\tokens for all tokens present in current batch
-            neglse = STC.logsubexp(lse, log_probs[:, :, 1:])
-            # print(f"Shape before concatenation:")
-            # print(f"  log_probs: {log_probs.shape}")
-            # print(f"  lse: {lse.shape}")
-            # print(f"  neglse: {neglse.shape}")
-            # concatenate (tokens, <star>, <star>\tokens)
-            log_probs = torch.cat([log_probs, lse, neglse], dim=2)
-            log_probs = log_probs.permute(1, 0, 2)
-            # Update the original vocab size after token selection
-            self._last_original_vocab_size = len(select_idx)
+        # remap the targets to their position in `select_idx`
+        targets = [
+            target.tolist()
+            for target in torch.split(target_map[flat_targets], lengths)
+        ]
+        # Store the vocab size after token selection for viterbi decoding
+        self._last_original_vocab_size = len(select_idx)
+
+        # the expansion only works along the last dimension, so the inputs
+        # keep the (B, T, C) layout of the model outputs throughout
+        with torch.set_grad_enabled(inputs.requires_grad):
+            log_probs = _stc_expand(inputs, select_idx)
         return STCLoss(log_probs, targets, prob, self.reduction)
 
     def viterbi(self, inputs):
@@ -246,7 +293,6 @@ class STC(torch.nn.Module):
         # (T, B, C) --> (B, T, C)
         log_probs = inputs.permute(1, 0, 2)
         B, T, C = log_probs.shape
-        decoded_sequences = []
 
         # Get the original vocabulary size (before STC expansion)
         # STC expands the vocabulary, so we need to be careful about indices
@@ -257,22 +303,42 @@ class STC(torch.nn.Module):
             # Conservative estimate: assume at most half the dimensions are original tokens
             original_vocab_size = min(C // 2, 100)
 
-        for b in range(B):
-            sequence = []
-            prev_token = None
-            for t in range(T):
-                # Only consider probabilities for the original vocabulary to avoid index errors
-                valid_probs = log_probs[b, t, :original_vocab_size]
-                token = torch.argmax(valid_probs).item()
-
-                # Additional safety check
-                if token >= original_vocab_size:
-                    token = STC_BLANK_IDX
-
-                # Avoid consecutive duplicate tokens and skip blank tokens
-                if token != prev_token and token != STC_BLANK_IDX:
-                    sequence.append(token)
-                prev_token = token
-            decoded_sequences.append(sequence)
-
-        return decoded_sequences
+        # Only consider the original vocabulary to avoid index errors
+        tokens = log_probs[:, :, :original_vocab_size].argmax(2)
+
+        # Avoid consecutive duplicate tokens and skip blank tokens
+        change = torch.ones_like(tokens, dtype=torch.bool)
+        change[:, 1:] = tokens[:, 1:] != tokens[:, :-1]
+        keep = change & (tokens != STC_BLANK_IDX)
+
+        # a single device to host copy for the whole batch
+        tokens, keep = tokens.cpu(), keep.cpu()
+        return [tokens[b][keep[b]].tolist() for b in range(B)]
+
+
+@torch.compile(dynamic=True)
+def _stc_expand(log_probs, select_idx):
+    """
+    Appends the <star> and <star>\\token scores to the tokens present in the
+    batch. Compiled so that the reduction, the elementwise ops and the
+    concatenation are fused instead of each sweeping the (B, T, C) tensor.
+
+    Args:
+        log_probs: Tensor of size (B, T, C)
+        select_idx: Tensor of the token indices present in the batch
+    Returns:
+        Tensor of size (B, T, 2 * len(select_idx))
+    """
+    # <star>: the inputs can be unnormalized scores, so the exponentials are
+    # max-shifted to stay finite (the max is fused into the same kernel)
+    scores = log_probs[:, :, 1:]
+    m = scores.amax(2, keepdim=True).detach()
+    m = m.masked_fill(m.isinf(), 0.0)
+    lse = m + (scores - m).exp().sum(2, keepdim=True).log()
+
+    log_probs = log_probs.index_select(2, select_idx)
+
+    # <star>\\tokens for all tokens present in current batch
+    neglse = STC.logsubexp(lse, log_probs[:, :, 1:])
+    # concatenate (tokens, <star>, <star>\\tokens)
+    return torch.cat([log_probs, lse, neglse], dim=2)
@@ -6,14 +6,14 @@ LICENSE file in the root directory of this source tree.
 """
 
 import collections
+from concurrent.futures import ThreadPoolExecutor
 import itertools
-import multiprocessing as mp
 import os
 import PIL.Image
 import random
 import re
 import torch
-from torchvision import transforms
+from torchvision.transforms import v2
 
 
 SPLITS = {
@@ -25,91 +25,108 @@ SPLITS = {
 
 class Dataset(torch.utils.data.Dataset):
     def __init__(self, data_path, preprocessor, split, augment=False):
-        forms = load_metadata(
-            data_path, use_words=preprocessor.use_words
-        )
-
         # Get split keys:
         splits = SPLITS.get(split, None)
         if splits is None:
             split_names = ", ".join(f"'{k}'" for k in SPLITS.keys())
             raise ValueError(f"Invalid split {split}, must be in [{split_names}].")
 
-        split_keys = []
+        split_keys = set()
         for s in splits:
             with open(os.path.join(data_path, f"{s}.txt"), "r") as fid:
-                split_keys.extend((l.strip() for l in fid))
+                split_keys.update((l.strip() for l in fid))
+
+        forms = load_metadata(
+            data_path, use_words=preprocessor.use_words, keys=split_keys
+        )
 
         self.preprocessor = preprocessor
         
-        # setup image transforms:
-        self.transforms = []
+        # setup image transforms, augmentations run on uint8 tensors:
+        self.transforms = [v2.ToImage()]
         if augment:
             self.transforms.extend(
                 [
                     RandomResizeCrop(),
-                    transforms.RandomRotation(2, fill=(255,)),
-                    transforms.ColorJitter(0.5, 0.5, 0.5, 0.5),
+                    v2.RandomRotation(2, fill=255),
+                    v2.ColorJitter(0.5, 0.5, 0.5, 0.5),
                 ]
             )
-        self.transforms.extend(
-            [
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.912], std=[0.168]),
-            ]
-        )
-        self.transforms = transforms.Compose(self.transforms)
+        self.transforms = v2.Compose(self.transforms)
+        # images stay uint8 and are normalized after the copy to the device:
+        self.normalization = (0.912, 0.168)
 
         # Load each image:
         images = []
         text = []
         for key, examples in forms.items():
             for example in examples:
-                if example["key"] not in split_keys:
-                    continue
-                images.append((example["path"], preprocessor.num_features))
-                text.append(example["text"])
-        with mp.Pool(processes=16) as pool:
-            images = pool.map(load_image, images)
-        self.dataset = list(zip(images, text))
+                images.append((example.path, preprocessor.num_features))
+                text.append(example.text)
+        self.images = list(_image_pool().map(load_image, images))
+        self.texts = text
+        # tokenize once here rather than on every fetch:
+        self.targets = [preprocessor.to_index(t) for t in text]
 
     def sample_sizes(self):
         """
         Returns a list of tuples containing the input size
         (width, height) and the output length for each sample.
         """
-        return [(image.size, len(text)) for image, text in self.dataset]
+        return [
+            (image.size, len(target))
+            for image, target in zip(self.images, self.targets)
+        ]
 
     def __getitem__(self, index):
-        img, text = self.dataset[index]
-        inputs = self.transforms(img)
-        outputs = self.preprocessor.to_index(text)
-        return inputs, outputs
+        return self.transforms(self.images[index]), self.targets[index]
 
     def __len__(self):
-        return len(self.dataset)
+        return len(self.images)
+
+
+_IMAGE_POOL = None
+
+
+def _image_pool():
+    """
+    Returns the pool used to load images, shared by every dataset built in
+    the process (e.g. the train and validation sets). PIL releases the GIL
+    while decoding and resizing, so threads suffice and avoid pickling every
+    image back from a worker process.
+    """
+    global _IMAGE_POOL
+    if _IMAGE_POOL is None:
+        _IMAGE_POOL = ThreadPoolExecutor(max_workers=16)
+    return _IMAGE_POOL
 
 
 def load_image(example):
     img_file, _ = example
-    img = PIL.Image.open(img_file)
+    with PIL.Image.open(img_file) as img:
+        # Get original dimensions
+        width, height = img.size
 
-    # Get original dimensions
-    width, height = img.size
+        # Desired new height
+        new_height = 64
 
-    # Desired new height
-    new_height = 64
+        # Calculate new width maintaining aspect ratio
+        if height == 0:
+            # Avoid division by zero, though unlikely for an image
+            new_width = width
+        else:
+            aspect_ratio = float(width) / height
+            new_width = int(aspect_ratio * new_height)
 
-    # Calculate new width maintaining aspect ratio
-    if height == 0:
-        # Avoid division by zero, though unlikely for an image
-        new_width = width 
-    else:
-        aspect_ratio = float(width) / height
-        new_width = int(aspect_ratio * new_height)
+        # Let JPEG decoders downscale while decoding (a no-op for PNG), and
+        # make sure the image is single channel before resizing:
+        img.draft("L", (new_width, new_height))
+        img = img.convert("L")
 
     # Resize the image to the new dimensions
-    img = img.resize((new_width, new_height), PIL.Image.Resampling.LANCZOS)
+    img = img.resize(
+        (new_width, new_height), PIL.Image.Resampling.BILINEAR, reducing_gap=3.0
+    )
 
     return img
 
@@ -120,10 +137,10 @@ class RandomResizeCrop:
         self.ratio = ratio
 
     def __call__(self, img):
-        w, h = img.size
+        h, w = v2.functional.get_size(img)
 
         # pad with white:
-        img = transforms.functional.pad(img, self.jitter, fill=255)
+        img = v2.functional.pad(img, self.jitter, fill=255)
 
         # crop at random (x, y):
         x = self.jitter + random.randint(-self.jitter, self.jitter)
@@ -132,7 +149,7 @@ class RandomResizeCrop:
         # randomize aspect ratio:
         size_w = w * random.uniform(1 - self.ratio, 1 + self.ratio)
         size = (h, int(size_w))
-        img = transforms.functional.resized_crop(img, y, x, h, w, size)
+        img = v2.functional.resized_crop(img, y, x, h, w, size, antialias=True)
         return img
 
 
@@ -169,11 +186,8 @@ class Preprocessor:
         forms = load_metadata(data_path, use_words=use_words)
 
         # Load the set of graphemes:
-        graphemes = set()
-        for _, form in forms.items():
-            for line in form:
-                graphemes.update(line["text"])
-        self.graphemes = sorted(graphemes)
+        text = "".join(line.text for form in forms.values() for line in form)
+        self.graphemes = sorted(set(text))
 
         # Build the token-to-index and index-to-token maps:
         if tokens_path is not None:
@@ -216,7 +230,7 @@ class Preprocessor:
                 tok_to_idx = self.tokens_to_index
         if self._prepend_wordsep:
             line = itertools.chain([self.wordsep], line)
-        return torch.LongTensor([tok_to_idx[t] for t in line])
+        return torch.tensor([tok_to_idx[t] for t in line], dtype=torch.int32)
 
     def to_text(self, indices):
         # Roughly the inverse of `to_index`
@@ -233,34 +247,38 @@ class Preprocessor:
         return "".join(indices).strip(self.wordsep)
 
 
-def load_metadata(data_path, use_words=False):
+Example = collections.namedtuple("Example", ["key", "path", "text"])
+
+
+def load_metadata(data_path, use_words=False, keys=None):
+    """
+    Loads the examples in words.txt grouped by form. If `keys` (a set) is
+    given, only the examples with those keys are loaded.
+    """
     forms = collections.defaultdict(list)
     filename = "words.txt"
+    words_path = os.path.join(data_path, "words")
     with open(os.path.join(data_path, filename), "r") as fid:
         for line in fid:
             if line.startswith("#"):  # Skip comment lines
                 continue
-            
-            parts = line.strip().split()
+
+            # Only the id and the word (the last field) are used, so stop
+            # splitting after the first fields and take the word from the
+            # end of the remainder (lines can have more than nine fields):
+            parts = line.split(None, 8)
             if len(parts) < 9: # Ensure the parts has enough parts
                 continue
-                
+
             word_id = parts[0]
-            segmentation_status = parts[1] # ok or err
-            text_label = parts[-1] # The actual word is the last part
-            id_parts = word_id.split('-')
-            path = os.path.join(data_path, "words", id_parts[0], f"{id_parts[0]}-{id_parts[1]}", f"{word_id}.png")
-            form_key = f"{id_parts[0]}-{id_parts[1]}"
+            if keys is not None and word_id not in keys:
+                continue
+            id_parts = word_id.split("-")
             if len(id_parts) < 2:
                 continue
-            line_key = "-".join(id_parts[:])
-            forms[form_key].append(
-                {
-                    "key": line_key,
-                    "path": path,
-                    "text": text_label,
-                }
-            )
+            form_key = f"{id_parts[0]}-{id_parts[1]}"
+            path = os.path.join(words_path, id_parts[0], form_key, f"{word_id}.png")
+            forms[form_key].append(Example(word_id, path, parts[8].rsplit(None, 1)[-1]))
     return forms
 
 
@@ -293,7 +311,7 @@ if __name__ == "__main__":
     trainset = Dataset(args.data_path, preprocessor, split="train", augment=False)
     if args.save_text is not None:
         with open(args.save_text, "w") as fid:
-            fid.write("\n".join(t for _, t in trainset.dataset))
+            fid.write("\n".join(trainset.texts))
     if args.save_tokens is not None:
         with open(args.save_tokens, "w") as fid:
             fid.write("\n".join(preprocessor.tokens))
@@ -309,6 +327,7 @@ if __name__ == "__main__":
 
     # Compute mean and var stats:
     images = torch.cat([trainset[i][0] for i in range(len(trainset))], dim=2)
+    images = images.float().div_(255)
     mean = torch.mean(images)
     std = torch.std(images)
     print(f"Data mean {mean} and standard deviation {std}.")
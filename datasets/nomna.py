@@ -6,7 +6,9 @@ LICENSE file in the root directory of this source tree.
 """
 
 import collections
+import functools
 import itertools
+import math
 import multiprocessing as mp
 import os
 import PIL.Image
@@ -21,10 +23,15 @@ SPLITS = {
     "test": ["validation"],
 }
 
+# Every image is resized to this height and padded (or squashed) to this width,
+# a multiple of 128 so the padded batches stay aligned for the conv kernels:
+IMAGE_HEIGHT = 64
+IMAGE_WIDTH = 896
+
 
 class Dataset(torch.utils.data.Dataset):
     def __init__(self, data_path, preprocessor, split, augment=False):
-        forms = load_metadata(data_path, use_words=preprocessor.use_words)
+        metadata = load_metadata(data_path, use_words=preprocessor.use_words)
 
         # Get split keys:
         splits = SPLITS.get(split, None)
@@ -32,12 +39,13 @@ class Dataset(torch.utils.data.Dataset):
             split_names = ", ".join(f"'{k}'" for k in SPLITS.keys())
             raise ValueError(f"Invalid split {split}, must be in [{split_names}].")
 
-        split_keys = []
+        split_keys = set()
         for s in splits:
             with open(os.path.join(data_path, f"{s}.txt"), "r") as fid:
-                split_keys.extend((l.strip() for l in fid))
+                split_keys.update((l.strip() for l in fid))
 
         self.preprocessor = preprocessor
+        self.augment = augment
 
         # setup image transforms:
         self.transforms = []
@@ -49,38 +57,67 @@ class Dataset(torch.utils.data.Dataset):
                     transforms.ColorJitter(0.5, 0.5, 0.5, 0.5),
                 ]
             )
-        self.transforms.extend(
-            [
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.912], std=[0.168]),
-            ]
-        )
+        # images are kept as uint8, the data loader normalizes them on the
+        # device with the (mean, std) below:
+        self.transforms.append(transforms.PILToTensor())
         self.transforms = transforms.Compose(self.transforms)
+        self.normalization = (0.912, 0.168)
 
-        # Load each image:
+        # Collect the examples, images are only loaded in `__getitem__` so
+        # that the data loader workers decode them while training runs
+        # (`lazy` asks the loader for workers even on a single GPU):
+        self.lazy = True
         images = []
         text = []
-        for key, examples in forms.items():
-            for example in examples:
-                if example["key"] not in split_keys:
-                    continue
-                images.append((example["path"], preprocessor.num_features))
-                text.append(example["text"])
-        with mp.Pool(processes=16) as pool:
-            images = pool.map(load_image, images)
+        self.keys = []
+        for key, path, t in zip(metadata.keys, metadata.paths, metadata.texts):
+            if key not in split_keys:
+                continue
+            images.append((path, preprocessor.num_features))
+            text.append(t)
+            self.keys.append(key)
         self.dataset = list(zip(images, text))
+        # use the decoded images written by `build_image_cache` if present:
+        self.image_cache = load_image_cache(data_path, split, self.keys)
+        # Tokenize every target once, stored back to back in one int32 tensor
+        # with the offset of each sample:
+        targets = [preprocessor.to_index(t).int() for t in text]
+        self.targets = torch.zeros(0, dtype=torch.int32)
+        if len(targets) > 0:
+            self.targets = torch.cat(targets)
+        # all images are loaded at the same size, so only the target lengths
+        # need to be stored:
+        self.target_lengths = torch.tensor(
+            [len(t) for t in targets], dtype=torch.int32
+        )
+        self.target_offsets = torch.zeros(len(targets) + 1, dtype=torch.long)
+        torch.cumsum(self.target_lengths, 0, out=self.target_offsets[1:])
 
     def sample_sizes(self):
         """
         Returns a list of tuples containing the input size
         (width, height) and the output length for each sample.
         """
-        return [(image.size, len(text)) for image, text in self.dataset]
+        size = (IMAGE_WIDTH, IMAGE_HEIGHT)
+        return [(size, l) for l in self.target_lengths.tolist()]
 
     def __getitem__(self, index):
-        img, text = self.dataset[index]
-        inputs = self.transforms(img)
-        outputs = self.preprocessor.to_index(text)
+        example, text = self.dataset[index]
+        if self.image_cache is None:
+            inputs = self.transforms(load_image(example))
+        elif self.augment:
+            # the augmentations work on PIL images
+            img = transforms.functional.to_pil_image(self.image_cache[index])
+            inputs = self.transforms(img)
+        else:
+            # copied out of the memory map, so that only this image is sent
+            # back from a loader worker
+            inputs = self.image_cache[index].clone()
+        # copied, a view would send the storage of every target back from a
+        # loader worker
+        outputs = self.targets[
+            self.target_offsets[index] : self.target_offsets[index + 1]
+        ].clone()
         return inputs, outputs
 
     def __len__(self):
@@ -89,28 +126,75 @@ class Dataset(torch.utils.data.Dataset):
 
 def load_image(example):
     img_file, _ = example
-    img = PIL.Image.open(img_file).convert("RGB")  # Ensure RGB mode
-    width, height = img.size
-    new_height = 64
-    target_width = 880
-    if height == 0:
-        new_width = width
-    else:
-        aspect_ratio = float(width) / height
-        new_width = int(aspect_ratio * new_height)
-    if new_width >= target_width:
-        img = img.resize((target_width, new_height), PIL.Image.Resampling.LANCZOS)
-    else:
-        img = img.resize((new_width, new_height), PIL.Image.Resampling.LANCZOS)
-        padded_img = PIL.Image.new(
-            "RGB", (target_width, new_height), color=(255, 255, 255)
-        )
+    with PIL.Image.open(img_file) as img:
+        width, height = img.size
+        new_height = IMAGE_HEIGHT
+        target_width = IMAGE_WIDTH
+        if height == 0:
+            new_width = width
+        else:
+            aspect_ratio = float(width) / height
+            new_width = int(aspect_ratio * new_height)
+        new_width = min(new_width, target_width)
+        # Decode straight to 1-channel grayscale (letting JPEG decoders
+        # downscale while decoding) rather than going through RGB:
+        img.draft("L", (new_width, new_height))
+        img = img.convert("L")
+    img = img.resize((new_width, new_height), PIL.Image.Resampling.LANCZOS)
+    if new_width < target_width:
+        padded_img = PIL.Image.new("L", (target_width, new_height), color=255)
         padded_img.paste(img, (0, 0))
         img = padded_img
-    img = img.convert("L")  # Convert to 1-channel grayscale
     return img
 
 
+def _image_cache_files(data_path, split):
+    prefix = os.path.join(data_path, f"{split}_images")
+    return prefix + ".bin", prefix + ".keys"
+
+
+def build_image_cache(dataset, data_path, split):
+    """
+    Writes the loaded images of `dataset` to a single uint8 file (and the
+    sample keys next to it) so later runs can memory map them instead of
+    decoding every image.
+    """
+    cache_file, keys_file = _image_cache_files(data_path, split)
+    examples = (example for example, _ in dataset.dataset)
+    with open(cache_file, "wb") as fid, mp.Pool(processes=os.cpu_count()) as pool:
+        # workers send back raw pixel bytes, in order and in large chunks:
+        for image in pool.imap(_load_image_bytes, examples, chunksize=256):
+            fid.write(image)
+    with open(keys_file, "w") as fid:
+        fid.write("\n".join(dataset.keys))
+
+
+def _load_image_bytes(example):
+    return load_image(example).tobytes()
+
+
+def load_image_cache(data_path, split, keys):
+    """
+    Returns a memory mapped (N, 1, IMAGE_HEIGHT, IMAGE_WIDTH) uint8 tensor of
+    the images written by `build_image_cache`, or None if there is no cache
+    for exactly the given sample `keys`.
+    """
+    cache_file, keys_file = _image_cache_files(data_path, split)
+    if not (os.path.exists(cache_file) and os.path.exists(keys_file)):
+        return None
+    with open(keys_file, "r") as fid:
+        if fid.read().split("\n") != keys:
+            return None
+    shape = (len(keys), 1, IMAGE_HEIGHT, IMAGE_WIDTH)
+    if os.path.getsize(cache_file) != math.prod(shape):
+        # the cache was built for a different image size:
+        return None
+    images = torch.from_file(
+        cache_file, shared=False, size=math.prod(shape), dtype=torch.uint8
+    )
+    return images.view(shape)
+
+
 class RandomResizeCrop:
     def __init__(self, jitter=10, ratio=0.5):
         self.jitter = jitter
@@ -119,18 +203,21 @@ class RandomResizeCrop:
     def __call__(self, img):
         w, h = img.size
 
-        # pad with white:
-        img = transforms.functional.pad(img, self.jitter, fill=255)
-
-        # crop at random (x, y):
-        x = self.jitter + random.randint(-self.jitter, self.jitter)
-        y = self.jitter + random.randint(-self.jitter, self.jitter)
+        # crop at random (x, y) from the image padded with white:
+        x = random.randint(-self.jitter, self.jitter)
+        y = random.randint(-self.jitter, self.jitter)
 
         # randomize aspect ratio:
-        size_w = w * random.uniform(1 - self.ratio, 1 + self.ratio)
-        size = (h, int(size_w))
-        img = transforms.functional.resized_crop(img, y, x, h, w, size)
-        return img
+        size_w = int(w * random.uniform(1 - self.ratio, 1 + self.ratio))
+
+        # pad, crop and resize with a single affine warp:
+        return img.transform(
+            (size_w, h),
+            PIL.Image.Transform.AFFINE,
+            (w / size_w, 0, x, 0, 1, y),
+            resample=PIL.Image.Resampling.BILINEAR,
+            fillcolor=255,
+        )
 
 
 class Preprocessor:
@@ -163,14 +250,10 @@ class Preprocessor:
         self._use_words = use_words
         self._prepend_wordsep = prepend_wordsep
 
-        forms = load_metadata(data_path, use_words=use_words)
+        metadata = load_metadata(data_path, use_words=use_words)
 
         # Load the set of graphemes:
-        graphemes = set()
-        for _, form in forms.items():
-            for line in form:
-                graphemes.update(line["text"])
-        self.graphemes = sorted(graphemes)
+        self.graphemes = sorted(set("".join(metadata.texts)))
         self.graphemes.insert(0, "BLANK")
 
         # Build the token-to-index and index-to-token maps:
@@ -192,6 +275,17 @@ class Preprocessor:
         self.tokens_to_index = {t: i for i, t in enumerate(self.tokens)}
         self.num_features = num_features
 
+        # Translation table from each single character grapheme to the
+        # character whose code point is its index, so that text can be
+        # tokenized with `str.translate` instead of a Python loop. Indices
+        # must stay below the UTF-16 surrogates to be encodable.
+        self._grapheme_table = None
+        if len(self.graphemes) < 0xD800:
+            self._grapheme_table = {
+                ord(g): i for g, i in self.graphemes_to_index.items() if len(g) == 1
+            }
+            self._grapheme_chars = set(map(chr, self._grapheme_table))
+
     @property
     def num_tokens(self):
         return len(self.tokens)
@@ -211,6 +305,12 @@ class Preprocessor:
                     for t in self.lexicon.get(w, self.wordsep + w)
                 ]
                 tok_to_idx = self.tokens_to_index
+        elif self._grapheme_table is not None:
+            text = self.wordsep + line if self._prepend_wordsep else line
+            # unknown graphemes take the slow path below to raise
+            if text and self._grapheme_chars.issuperset(text):
+                text = text.translate(self._grapheme_table).encode("utf-32-le")
+                return torch.frombuffer(bytearray(text), dtype=torch.int32).long()
         if self._prepend_wordsep:
             line = itertools.chain([self.wordsep], line)
         return torch.LongTensor([tok_to_idx[t] for t in line])
@@ -220,39 +320,87 @@ class Preprocessor:
         encoding = self.graphemes
         if self.lexicon is not None:
             encoding = self.tokens
-        # Add safety check to prevent index out of bounds
-        safe_indices = [i for i in indices if 0 <= i < len(encoding)]
-        return self._post_process(encoding[i] for i in safe_indices)
+        return self._post_process(self._lookup(encoding, indices))
 
     def tokens_to_text(self, indices):
-        # Add safety check to prevent index out of bounds
-        safe_indices = [i for i in indices if 0 <= i < len(self.tokens)]
-        return self._post_process(self.tokens[i] for i in safe_indices)
+        return self._post_process(self._lookup(self.tokens, indices))
+
+    @staticmethod
+    def _lookup(encoding, indices):
+        # Add safety check to prevent index out of bounds, filtering and
+        # looking up in one list comprehension (joining a list is faster
+        # than joining a generator)
+        num_entries = len(encoding)
+        return [encoding[i] for i in indices if 0 <= i < num_entries]
 
     def _post_process(self, indices):
         # ignore preceding and trailling spaces
         return "".join(indices).strip(self.wordsep)
 
 
+Metadata = collections.namedtuple("Metadata", ["keys", "paths", "texts"])
+
+
+@functools.lru_cache(maxsize=4)
 def load_metadata(data_path, use_words=False):
-    forms = collections.defaultdict(list)
-    filename = "nomna-all.txt"
-    with open(os.path.join(data_path, filename), "r") as fid:
-        for line in fid:
-            parts = line.strip().split("\t")
-            word_id = parts[0]
-            text_label = parts[-1]  # The actual word is the last part
-            path = os.path.join(data_path, word_id)
-            form_key = word_id.split("/")[0]
-
-            forms[form_key].append(
-                {
-                    "key": word_id,
-                    "path": path,
-                    "text": text_label,
-                }
+    """
+    Loads the keys, image paths and texts of the examples in nomna-all.txt
+    as parallel tuples. The result is cached so the preprocessor and every
+    split built in the same process parse the file once.
+    """
+    metadata_file, cache_file = _metadata_files(data_path)
+    metadata = None
+    if os.path.exists(cache_file) and (
+        not os.path.exists(metadata_file)
+        or os.path.getmtime(cache_file) >= os.path.getmtime(metadata_file)
+    ):
+        metadata = _read_metadata_cache(cache_file)
+    if metadata is None:
+        keys, texts = [], []
+        with open(metadata_file, "r") as fid:
+            for line in fid:
+                parts = line.strip().split("\t")
+                keys.append(parts[0])
+                texts.append(parts[-1])  # The actual word is the last part
+        metadata = tuple(keys), tuple(texts)
+    keys, texts = metadata
+    paths = tuple(os.path.join(data_path, key) for key in keys)
+    return Metadata(keys, paths, texts)
+
+
+def _metadata_files(data_path):
+    prefix = os.path.join(data_path, "nomna-all")
+    return prefix + ".txt", prefix + ".cache"
+
+
+def _read_metadata_cache(cache_file):
+    # the number of examples, then every key and then every text, one per
+    # line, so that the file is parsed with a single split
+    with open(cache_file, "r") as fid:
+        lines = fid.read().split("\n")
+    try:
+        n = int(lines[0])
+    except ValueError:
+        return None
+    if len(lines) != 2 * n + 1:
+        return None
+    return tuple(lines[1 : n + 1]), tuple(lines[n + 1 :])
+
+
+def build_metadata_cache(data_path):
+    """
+    Writes the parsed keys and texts of nomna-all.txt next to it as plain
+    text so `load_metadata` can skip parsing each line. The cache is ignored
+    once nomna-all.txt is modified.
+    """
+    metadata = load_metadata(data_path)
+    _, cache_file = _metadata_files(data_path)
+    with open(cache_file, "w") as fid:
+        fid.write(
+            "\n".join(
+                (str(len(metadata.keys)),) + metadata.keys + metadata.texts
             )
-    return forms
+        )
 
 
 if __name__ == "__main__":
@@ -278,6 +426,13 @@ if __name__ == "__main__":
         help="Compute training data statistics.",
         default=False,
     )
+    parser.add_argument(
+        "--build_cache",
+        action="store_true",
+        help="Save the parsed metadata and the decoded train and validation "
+        "images for faster loading.",
+        default=False,
+    )
     args = parser.parse_args()
 
     preprocessor = Preprocessor(args.data_path, 64, use_words=args.use_words)
@@ -293,17 +448,28 @@ if __name__ == "__main__":
     print(f"Training: {len(trainset)}")
     print(f"Validation: {len(valset)}")
 
+    if args.build_cache:
+        build_metadata_cache(args.data_path)
+        build_image_cache(trainset, args.data_path, "train")
+        build_image_cache(valset, args.data_path, "validation")
+
     if not args.compute_stats:
         import sys
 
         print("here")
         sys.exit(0)
 
-    # Compute mean and var stats:
-    images = torch.cat([trainset[i][0] for i in range(len(trainset))], dim=2)
-    mean = torch.mean(images)
-    std = torch.std(images)
-    print(f"Data mean {mean} and standard deviation {std}.")
+    # Compute mean and var stats, accumulating exact integer sums of the
+    # uint8 pixels one image at a time:
+    total, total_sq, count = 0, 0, 0
+    for i in range(len(trainset)):
+        image = trainset[i][0].long()
+        total += image.sum().item()
+        total_sq += image.square().sum().item()
+        count += image.numel()
+    mean = total / count
+    std = math.sqrt((total_sq - total * mean) / (count - 1))
+    print(f"Data mean {mean / 255} and standard deviation {std / 255}.")
 
     # Compute average lengths of images and targets:
     avg_im_w = sum(w for (w, _), _ in trainset.sample_sizes()) / len(trainset)
@@ -26,8 +26,8 @@ def iamdb_pieces(args):
                 ds_keys.update(l.strip() for l in fid)
 
     # Train sentencepiece model only on the training set
-    text = [l["text"] for _, lines in forms.items()
-        for l in lines if l["key"] not in ds_keys]
+    text = [l.text for _, lines in forms.items()
+        for l in lines if l.key not in ds_keys]
     num_pieces = args.num_pieces
     sp = train_spm_model(
         iter(text),
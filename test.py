@@ -72,7 +72,7 @@ def test(args):
         prepend_wordsep=config["data"].get("prepend_wordsep", False),
     )
     data = dataset.Dataset(data_path, preprocessor, split=args.split)
-    loader = utils.data_loader(data, config)
+    loader = utils.data_loader(data, config, device=device)
 
     criterion, output_size = models.load_criterion(
         config.get("criterion_type", "ctc"),
@@ -28,7 +28,7 @@ class TestSTCCriterion(unittest.TestCase):
         labels = [[1, 1]]
         emissions = (
             torch.FloatTensor([0.0, 1.0, 1.0, 0.0, 0.0, 1.0])
-            .view(T, 1, N)
+            .view(1, T, N)
             .to(self.device)
         )
         log_probs = torch.log(emissions)
@@ -40,7 +40,7 @@ class TestSTCCriterion(unittest.TestCase):
         T = 3
         N = 4
         labels = [[1, 2]]
-        emissions = torch.FloatTensor([1.0] * T * N).view(T, 1, N).to(self.device)
+        emissions = torch.FloatTensor([1.0] * T * N).view(1, T, N).to(self.device)
         log_probs = torch.log(emissions)
         m = torch.nn.LogSoftmax(2)
         log_probs = m(log_probs)
@@ -50,6 +50,65 @@ class TestSTCCriterion(unittest.TestCase):
         # [0,2-3],1,2 ; 1,2,[0-1,3] ; 1,[0-3],2
         self.assertAlmostEqual(fwd.item(), -math.log(0.25 * 0.25 * (0.75 + 0.75 + 1)))
 
+    def test_fwd_batch(self):
+        # (B, T, C) inputs as output by the models, with B != T
+        B, T, N = 2, 7, 5
+        labels = [[1, 2], [3]]
+        log_probs = torch.randn(B, T, N, device=self.device).log_softmax(2)
+        stc_crit = stc.STC(0, 1, 1, 1, "none")
+        fwd = stc_crit(log_probs, labels)
+        # the loss is the mean of the loss of each sample
+        expected = sum(
+            stc_crit(log_probs[b : b + 1], [labels[b]]) for b in range(B)
+        ) / B
+        self.assertAlmostEqual(fwd.item(), expected.item(), places=4)
+
+    def test_criterion_cache(self):
+        stc._clear_stale_stc_criteria(0.5)
+        g = stc._stc_criterion((1, 2), 3, 0.5)
+        self.assertIs(stc._stc_criterion((1, 2), 3, 0.5), g)
+
+        # the same penalty keeps the cached graphs
+        stc._clear_stale_stc_criteria(0.5)
+        self.assertIs(stc._stc_criterion((1, 2), 3, 0.5), g)
+
+        # a new penalty drops them
+        stc._clear_stale_stc_criteria(0.25)
+        self.assertEqual(stc._stc_criterion.cache_info().currsize, 0)
+
+    def test_logsubexp(self):
+        a = torch.randn(2, 3, 1, device=self.device)
+        b = a - torch.rand(2, 3, 5, device=self.device) - 0.1
+        expected = torch.log(torch.exp(a) - torch.exp(b))
+        self.assertTrue(torch.allclose(stc.STC.logsubexp(a, b), expected, atol=1e-5))
+
+        a.requires_grad_(True)
+        out = stc.STC.logsubexp(a, b)
+        self.assertEqual(out.shape, b.shape)
+        self.assertTrue(torch.allclose(out, expected, atol=1e-5))
+
+    def test_expand_large_scores(self):
+        # unnormalized scores must not overflow the <star> logsumexp
+        log_probs = 60 + 50 * torch.randn(2, 4, 6, device=self.device)
+        select_idx = torch.tensor([0, 2, 5], device=self.device)
+        expanded = stc._stc_expand(log_probs, select_idx)
+        self.assertEqual(expanded.shape, (2, 4, 6))
+        lse = torch.logsumexp(log_probs[:, :, 1:], 2)
+        self.assertTrue(torch.allclose(expanded[:, :, 3], lse))
+        self.assertTrue(torch.isfinite(expanded).all())
+
+    def test_viterbi(self):
+        # best path per frame: [1, 1, 0, 1, 2] and [0, 2, 2, 0, 0]
+        paths = [[1, 1, 0, 1, 2], [0, 2, 2, 0, 0]]
+        T, B, C = 5, len(paths), 3
+        log_probs = torch.full((T, B, C), -10.0, device=self.device)
+        for b, path in enumerate(paths):
+            for t, token in enumerate(path):
+                log_probs[t, b, token] = 0.0
+        stc_crit = stc.STC(0)
+        stc_crit._last_original_vocab_size = C
+        self.assertEqual(stc_crit.viterbi(log_probs), [[1, 1, 2], [2]])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -10,6 +10,7 @@ import sys
 sys.path.append("..")
 
 import unittest
+import torch
 import utils
 
 
@@ -35,5 +36,72 @@ class UnpackReplabel(unittest.TestCase):
         self.assertEqual(unrep2, [0, 0, 0, 1, 1, 1, 2, 2, 2, 2, 3, 4, 4])
 
 
+class PaddingCollate(unittest.TestCase):
+    def test_uint8(self):
+        samples = [
+            (torch.zeros((1, 2, 3), dtype=torch.uint8), [1]),
+            (torch.zeros((1, 2, 5), dtype=torch.uint8), [2, 3]),
+        ]
+        inputs, targets = utils.padding_collate(samples)
+        self.assertEqual(inputs.dtype, torch.uint8)
+        self.assertEqual(inputs.shape, (2, 2, 5))
+        # padded with white:
+        self.assertTrue((inputs[0, :, 3:] == 255).all())
+        self.assertTrue((inputs[0, :, :3] == 0).all())
+        self.assertTrue((inputs[1] == 0).all())
+        self.assertEqual(targets, ([1], [2, 3]))
+
+    def test_float(self):
+        samples = [(torch.ones((1, 2, 3)), [1]), (torch.ones((1, 2, 4)), [2])]
+        inputs, _ = utils.padding_collate(samples)
+        self.assertEqual(inputs.dtype, torch.float32)
+        self.assertEqual(inputs.shape, (2, 2, 4))
+        self.assertTrue((inputs[0, :, 3:] == 0).all())
+        self.assertTrue((inputs[0, :, :3] == 1).all())
+
+
+class PrefetchLoader(unittest.TestCase):
+    def test_normalize(self):
+        inputs = torch.randint(0, 256, (2, 3, 4), dtype=torch.uint8)
+        loader = [(inputs, ([1], [2]))]
+        mean, std = 0.9, 0.2
+        prefetcher = utils.PrefetchLoader(loader, torch.device("cpu"), (mean, std))
+        self.assertEqual(len(prefetcher), 1)
+        (out, targets), = list(prefetcher)
+        self.assertEqual(out.dtype, torch.float32)
+        expected = (inputs.float() - mean * 255) / (std * 255)
+        self.assertTrue(torch.allclose(out, expected))
+        self.assertEqual(targets, ([1], [2]))
+
+    def test_no_normalization(self):
+        inputs = torch.randn(2, 3, 4)
+        loader = [(inputs, ([1], [2]))]
+        prefetcher = utils.PrefetchLoader(loader, torch.device("cpu"))
+        (out, targets), = list(prefetcher)
+        self.assertTrue(torch.equal(out, inputs))
+        self.assertEqual(targets, ([1], [2]))
+
+
+class DataLoader(unittest.TestCase):
+    class Dataset(torch.utils.data.Dataset):
+        normalization = (0.5, 0.25)
+
+        def __getitem__(self, index):
+            return torch.full((1, 2, 3), 255, dtype=torch.uint8), [index]
+
+        def __len__(self):
+            return 2
+
+        def sample_sizes(self):
+            return [((3, 2), 1)] * len(self)
+
+    def test_normalize_without_device(self):
+        config = {"data": {}, "optim": {"batch_size": 2}}
+        loader = utils.data_loader(self.Dataset(), config)
+        (inputs, targets), = list(loader)
+        self.assertEqual(inputs.dtype, torch.float32)
+        self.assertTrue(torch.allclose(inputs, torch.full((2, 2, 3), 2.0)))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -171,8 +171,12 @@ def train(world_rank, args):
     )
     trainset = dataset.Dataset(data_path, preprocessor, split="train", augment=True)
     valset = dataset.Dataset(data_path, preprocessor, split="validation")
-    train_loader = utils.data_loader(trainset, config, world_rank, args.world_size)
-    val_loader = utils.data_loader(valset, config, world_rank, args.world_size)
+    train_loader = utils.data_loader(
+        trainset, config, world_rank, args.world_size, device=device
+    )
+    val_loader = utils.data_loader(
+        valset, config, world_rank, args.world_size, device=device
+    )
 
     # setup criterion, model:
     logging.info("Loading model ...")
@@ -18,19 +18,40 @@ from criterions import ctc, asg, stc, transducer
 from models import rnn, tds, tds2d
 
 
-def data_loader(dataset, config, world_rank=0, world_size=1):
+def data_loader(dataset, config, world_rank=0, world_size=1, device=None):
+    # datasets emitting uint8 images leave the normalization to the loader:
+    normalization = getattr(dataset, "normalization", None)
+    lazy = getattr(dataset, "lazy", False)
     num_samples = config["data"].get("num_samples", None)
     if num_samples is not None:
         logging.info(f"Using {num_samples} of {len(dataset)}.")
         dataset = Subset(dataset, torch.randperm(len(dataset))[:num_samples])
-    return torch.utils.data.DataLoader(
+    # datasets decoding their images on fetch need workers to keep up:
+    default_workers = int(world_size > 1)
+    if lazy:
+        default_workers = min(8, os.cpu_count() or 1)
+    num_workers = config["data"].get("num_workers", default_workers)
+    worker_kwargs = {}
+    if num_workers > 0:
+        # avoid running out of file descriptors when workers share tensors
+        torch.multiprocessing.set_sharing_strategy("file_system")
+        worker_kwargs = {"persistent_workers": True, "prefetch_factor": 4}
+    loader = torch.utils.data.DataLoader(
         dataset,
         batch_sampler=BatchSortedSampler(
             dataset, config["optim"]["batch_size"], world_rank, world_size
         ),
         collate_fn=padding_collate,
-        num_workers=int(world_size > 1),
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        **worker_kwargs,
     )
+    if device is None and normalization is not None:
+        # the inputs still need normalizing, do it on the CPU
+        device = torch.device("cpu")
+    if device is not None:
+        loader = PrefetchLoader(loader, device, normalization)
+    return loader
 
 
 def module_from_file(module_name, file_path):
@@ -58,9 +79,8 @@ class Subset(torch.utils.data.Subset):
 class BatchSortedSampler(torch.utils.data.Sampler):
     def __init__(self, dataset, batch_size, world_rank, world_size, shuffle=True):
         local_batchsize = batch_size // world_size
-        widths = (in_size[0] for in_size, _ in dataset.sample_sizes())
-        sorted_dataset = sorted(enumerate(widths), key=lambda x: x[1])
-        sorted_indices, _ = zip(*sorted_dataset)
+        widths = torch.tensor([in_size[0] for in_size, _ in dataset.sample_sizes()])
+        sorted_indices = torch.argsort(widths, stable=True).tolist()
         global_batches = [
             sorted_indices[idx : idx + local_batchsize]
             for idx in range(0, len(sorted_indices), local_batchsize)
@@ -86,13 +106,70 @@ def padding_collate(samples):
     # collate inputs:
     h = inputs[0].shape[1]
     max_input_len = max(ip.shape[2] for ip in inputs)
-    batch_inputs = torch.zeros((len(inputs), inputs[0].shape[1], max_input_len))
+    # uint8 images are padded with white, normalized inputs with zeros
+    fill = 255 if inputs[0].dtype == torch.uint8 else 0
+    batch_inputs = torch.full(
+        (len(inputs), inputs[0].shape[1], max_input_len),
+        fill,
+        dtype=inputs[0].dtype,
+    )
     for e, ip in enumerate(inputs):
         batch_inputs[e, :, : ip.shape[2]] = ip
 
     return batch_inputs, targets
     
 
+class PrefetchLoader:
+    """
+    Wraps a data loader to copy the inputs of the next batch to `device` on
+    a side stream while the current batch is being processed.
+
+    Args:
+        loader : The data loader to wrap.
+        device (torch.device) : The device to copy the inputs to.
+        normalization (tuple) (optional) : The (mean, std) of the pixel
+            values in [0, 1]. If provided the inputs are expected to be
+            uint8 images and are normalized on the device after the copy.
+    """
+
+    def __init__(self, loader, device, normalization=None):
+        self.loader = loader
+        self.device = device
+        self.mean = self.std = None
+        if normalization is not None:
+            mean, std = normalization
+            self.mean = torch.tensor(mean * 255, device=device)
+            self.std = torch.tensor(std * 255, device=device)
+
+    def _prepare(self, inputs):
+        inputs = inputs.to(self.device, non_blocking=True)
+        if self.mean is not None:
+            inputs = inputs.float().sub_(self.mean).div_(self.std)
+        return inputs
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for inputs, targets in self.loader:
+                yield self._prepare(inputs), targets
+            return
+
+        stream = torch.cuda.Stream()
+        batch = None
+        for inputs, targets in self.loader:
+            with torch.cuda.stream(stream):
+                inputs = self._prepare(inputs)
+            if batch is not None:
+                yield batch
+            torch.cuda.current_stream().wait_stream(stream)
+            inputs.record_stream(torch.cuda.current_stream())
+            batch = (inputs, targets)
+        if batch is not None:
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
+
+
 @dataclass
 class Meters:
     loss = 0.0
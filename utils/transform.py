@@ -1,22 +1,19 @@
+import re
+
+# word id, three skipped fields, the bounding box (x, y, w, h), any further
+# fields and the transcription as the last field
+WORDS_LINE = re.compile(
+    rb"(?!#)(\S+)(?:\s+\S+){3}\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)(?:\s+\S+)*\s+(\S+)\s*$"
+)
+
+
 def transform_words_file(input_file, output_file):
-    with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
-        for line in infile:
-            # Skip comments and empty lines
-            if line.startswith('#') or not line.strip():
-                continue
-            
-            # Split the line into components
-            parts = line.strip().split()
-            
-            # Check if the line has enough parts to process
-            if len(parts) >= 8:
-                # Extract required fields
-                key = parts[0]  # word id
-                box = ' '.join(parts[4:8])  # bounding box (x, y, w, h)
-                text = parts[-1]  # transcription
-                
-                # Write to output file
-                outfile.write(f"{key} {box} {text}\n")
+    with open(input_file, 'rb') as infile, open(output_file, 'wb') as outfile:
+        # Comments, empty lines and lines without enough fields don't match
+        matches = (WORDS_LINE.match(line) for line in infile)
+        outfile.writelines(
+            b"%s %s %s %s %s %s\n" % m.groups() for m in matches if m is not None
+        )
 
 # Example usage
 if __name__ == "__main__":